@@ -0,0 +1,43 @@
+import _thread
+import sys
+import threading
+import read_and_store
+import read_and_store_temp
+
+def main():
+    print("[DEBUG] main.py starting flowmeter and temperature readers...")
+    # One Supabase client (and keep-alive connection pool) for both readers
+    supabase = read_and_store.connect_supabase()
+
+    # Temperature reader polls every READ_INTERVAL; run it alongside the flowmeter.
+    # It returns (or raises) only when it has given up, so treat that as fatal.
+    temp_stopped = threading.Event()
+
+    def run_temp():
+        try:
+            read_and_store_temp.main(supabase=supabase)
+        except Exception as e:
+            print(f"[Error] Temperature reader crashed: {e}")
+        finally:
+            temp_stopped.set()
+            print("[Error] Temperature reader stopped - shutting down")
+            # Raises KeyboardInterrupt in the flowmeter loop so it shuts down cleanly
+            _thread.interrupt_main()
+
+    temp_thread = threading.Thread(target=run_temp, name='temp_reader', daemon=True)
+    temp_thread.start()
+
+    # Flowmeter stays on the main thread so Ctrl+C reaches its shutdown handling.
+    # A SerialException propagates and exits non-zero on its own.
+    try:
+        stopped_by_user = read_and_store.main(supabase=supabase)
+    except KeyboardInterrupt:
+        # Interrupted while still connecting to the flowmeter port
+        stopped_by_user = True
+
+    # Exit non-zero if either reader gave up, so the container restart policy applies
+    if temp_stopped.is_set() or not stopped_by_user:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,32 +2,85 @@ import os
 import serial
 from collections import deque
 import re
-from datetime import datetime, timezone
+from datetime import datetime
 import time
-import pytz
-from supabase import create_client
+import queue
+import sqlite3
+import threading
+import httpx
+from supabase import create_client, ClientOptions
 from dotenv import load_dotenv
 
+# Fallback patterns for flowmeter lines the fast path can't split cleanly
+_FLOW_RE = re.compile(r'Flow\s+([\d.]+)\s+l/s')
+_VEL_RE = re.compile(r'Vel:\s+([\d.]+)\s+m/s')
+_READING_CHARS = frozenset('0123456789.')
+
+def _parse_reading(text):
+    """Parse a digits-and-dots reading, like the regexes; bare float() also takes signs, exponents, nan/inf"""
+    if not text or not _READING_CHARS.issuperset(text):
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        # More than one dot, e.g. '1.2.3'
+        return None
+
+def create_supabase_client(url, key):
+    """Create a Supabase client that reuses one keep-alive HTTP/2 connection pool"""
+    # Keep idle connections longer than the upload cadence so each batch
+    # skips the TLS handshake; retry failed connection attempts twice
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60)
+    )
+    http_client = httpx.Client(transport=transport, timeout=30.0, follow_redirects=True)
+    return create_client(url, key, options=ClientOptions(httpx_client=http_client))
+
+def connect_supabase():
+    """Create the Supabase client from SUPABASE_URL / SUPABASE_KEY"""
+    load_dotenv()
+    url = os.getenv('SUPABASE_URL')
+    key = os.getenv('SUPABASE_KEY')
+    if not all([url, key]):
+        raise ValueError("Missing Supabase credentials in environment variables")
+    return create_supabase_client(url, key)
+
 class FlowmeterDataCollector:
-    def __init__(self, port, baudrate=9600, buffer_size=1000):
+    def __init__(self, port, baudrate=9600, buffer_size=1000, batch_size=32, flush_interval=5.0,
+                 upload_queue_size=1000, max_backoff=60.0, spool_path='data/spool.db',
+                 supabase=None, shutdown_timeout=60.0):
         self.serial_port = port
         self.baudrate = baudrate
         self.buffer_size = buffer_size
         self.ring_buffer = deque(maxlen=buffer_size)
         self.current_record = {'timestamp': None, 'flow': None, 'velocity': None}
         self.ser = None
-        self.bangkok_tz = pytz.timezone('Asia/Bangkok')
         
-        # Load environment variables
-        load_dotenv()
+        # Records waiting for the background uploader; None is the stop sentinel
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._upload_q = queue.Queue(maxsize=upload_queue_size)
+        self._uploader_thread = threading.Thread(target=self._uploader, daemon=True)
+        self._stopping = threading.Event()
+        self.shutdown_timeout = shutdown_timeout
         
-        # Supabase setup
-        self.supabase_url = os.getenv('SUPABASE_URL')
-        self.supabase_key = os.getenv('SUPABASE_KEY')
-        if not all([self.supabase_url, self.supabase_key]):
-            raise ValueError("Missing Supabase credentials in environment variables")
+        # Circuit breaker: after a failed insert, pause uploads for an
+        # exponentially growing period instead of hitting a dead endpoint
+        self.max_backoff = max_backoff
+        self._fail_count = 0
+        self._open_until = 0.0
         
-        self.supabase = create_client(self.supabase_url, self.supabase_key)
+        # Local SQLite spool for batches Supabase rejected; owned by the uploader thread
+        self.spool_path = spool_path
+        self._spool = None
+        # Assume leftovers from a previous run until a drain finds the spool empty
+        self._spool_has_rows = True
+        
+        # Supabase setup; reuse the caller's client when several collectors share a process
+        self.supabase = supabase if supabase is not None else connect_supabase()
+        self.supabase_url = os.getenv('SUPABASE_URL')
         
     def connect_serial(self):
         """Establish serial connection with retries"""
@@ -55,24 +108,41 @@ class FlowmeterDataCollector:
         """Parse individual lines of data from the flowmeter"""
         line = line.strip()
         
-        # Timestamp line
-        timestamp_match = re.match(r'(\d{2}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})', line)
-        if timestamp_match:
-            naive_dt = datetime.strptime(timestamp_match.group(1), '%y-%m-%d %H:%M:%S')
-            localized_dt = self.bangkok_tz.localize(naive_dt)
-            self.current_record['timestamp'] = localized_dt.isoformat()
+        # Timestamp line (fixed width: YY-MM-DD HH:MM:SS)
+        if len(line) >= 17 and line[2] == '-' and line[5] == '-' and line[8] == ' ':
+            try:
+                naive_dt = datetime.strptime(line[:17], '%y-%m-%d %H:%M:%S')
+            except ValueError:
+                return False
+            # Device clock only marks the start of a record; store_record
+            # stamps the upload with UTC, so no timezone conversion here
+            self.current_record['timestamp'] = naive_dt
             return False
             
         # Flow line
-        flow_match = re.match(r'Flow\s+([\d.]+)\s+l/s', line)
-        if flow_match:
-            self.current_record['flow'] = float(flow_match.group(1))
+        if line.startswith('Flow'):
+            parts = line.split()
+            if len(parts) >= 3 and parts[0] == 'Flow' and parts[2] == 'l/s':
+                flow = _parse_reading(parts[1])
+            else:
+                # Unusual spacing/format, fall back to the full pattern
+                flow_match = _FLOW_RE.match(line)
+                flow = _parse_reading(flow_match.group(1)) if flow_match else None
+            if flow is not None:
+                self.current_record['flow'] = flow
             return False
             
         # Velocity line
-        vel_match = re.match(r'Vel:\s+([\d.]+)\s+m/s', line)
-        if vel_match:
-            self.current_record['velocity'] = float(vel_match.group(1))
+        if line.startswith('Vel:'):
+            parts = line.split()
+            if len(parts) >= 3 and parts[0] == 'Vel:' and parts[2] == 'm/s':
+                velocity = _parse_reading(parts[1])
+            else:
+                vel_match = _VEL_RE.match(line)
+                velocity = _parse_reading(vel_match.group(1)) if vel_match else None
+            if velocity is None:
+                return False
+            self.current_record['velocity'] = velocity
             return True
             
         return False
@@ -81,75 +151,280 @@ class FlowmeterDataCollector:
         """Process all complete records in the ring buffer"""
         while self.ring_buffer:
             line = self.ring_buffer.popleft()
+            # parse_data_line only returns True once velocity is set
             if self.parse_data_line(line):
-                if all(self.current_record.values()):
+                record = self.current_record
+                if record['timestamp'] is not None and record['flow'] is not None:
                     self.store_record()
                     self.current_record = {'timestamp': None, 'flow': None, 'velocity': None}
     
     def store_record(self):
-        """Store a complete record in Supabase with error handling"""
+        """Hand a complete record to the uploader thread without blocking"""
+        # Use UTC ISO 8601 timestamp
+        record = {
+            'timestamp': self._utc_timestamp(),
+            'flow': self.current_record['flow'],
+            'velocity': self.current_record['velocity'],
+        }
         try:
-            # Use UTC ISO 8601 timestamp
-            utc_now = datetime.now(timezone.utc).isoformat()
-            self.current_record['timestamp'] = utc_now
-            response = self.supabase.table('flow_data').insert({
-                'timestamp': self.current_record['timestamp'],
-                'flow': self.current_record['flow'],
-                'velocity': self.current_record['velocity'],
-            }).execute()
+            self._upload_q.put_nowait(record)
+        except queue.Full:
+            # Uploads are falling behind; drop the oldest record to keep reading
+            try:
+                self._upload_q.get_nowait()
+            except queue.Empty:
+                pass
+            print("Upload queue full - dropped oldest record")
+            self._upload_q.put_nowait(record)
+    
+    def _utc_timestamp(self):
+        """Current UTC time as ISO 8601, without building a datetime"""
+        second, ns = divmod(time.time_ns(), 1_000_000_000)
+        return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))}.{ns // 1000:06d}+00:00"
+    
+    def _uploader(self):
+        """Background thread: collect records into batches and insert them"""
+        # sqlite3 connections are tied to the thread that opened them.
+        # The spool is only a fallback: keep uploading without it if it can't open.
+        try:
+            self._spool = self._open_spool()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Spool unavailable at {self.spool_path}, failed uploads will be dropped: {e}")
+            self._spool = None
+        stopping = False
+        while not stopping:
+            delay = self._open_until - time.monotonic()
+            if delay > 0:
+                if self._spool is None:
+                    # Breaker open, nowhere to divert: wait it out (or until shutdown)
+                    self._stopping.wait(delay)
+                else:
+                    # Breaker open: move arriving records to the spool so the
+                    # bounded queue never overflows during an outage
+                    try:
+                        record = self._upload_q.get(timeout=delay)
+                    except queue.Empty:
+                        continue
+                    if record is None:
+                        break
+                    stopping = self._spill_queue([record])
+                    continue
+            # Older spooled records go first; the drain doubles as the breaker probe
+            if self._spool_has_rows:
+                self._drain_spool()
+                if self._spool_has_rows:
+                    continue
+            record = self._upload_q.get()
+            if record is None:
+                break
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self._upload_q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            ok = self.insert_batch(batch)
+            self._record_upload_result(ok)
+            if not ok:
+                if self._spool is None:
+                    self._spool_records(batch)
+                else:
+                    stopping = self._spill_queue(batch) or stopping
+        if self._spool is not None:
+            self._spool.close()
+    
+    def _spill_queue(self, batch):
+        """Spool `batch` plus everything waiting in the queue; return True if the stop sentinel was seen"""
+        saw_sentinel = False
+        while True:
+            try:
+                record = self._upload_q.get_nowait()
+            except queue.Empty:
+                break
+            if record is None:
+                saw_sentinel = True
+                break
+            batch.append(record)
+        if batch:
+            self._spool_records(batch)
+        return saw_sentinel
+    
+    def _open_spool(self):
+        """Open (creating if needed) the local spool database"""
+        spool_dir = os.path.dirname(self.spool_path)
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        conn = sqlite3.connect(self.spool_path, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS flow_spool ('
+                     'id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, '
+                     'flow REAL NOT NULL, velocity REAL NOT NULL)')
+        return conn
+    
+    def _spool_records(self, batch):
+        """Keep a failed batch on disk so it can be uploaded later"""
+        if self._spool is None:
+            print(f"No spool, {len(batch)} records lost")
+            return
+        try:
+            self._spool.execute('BEGIN')
+            self._spool.executemany(
+                'INSERT INTO flow_spool (timestamp, flow, velocity) VALUES (?, ?, ?)',
+                [(r['timestamp'], r['flow'], r['velocity']) for r in batch])
+            self._spool.execute('COMMIT')
+            self._spool_has_rows = True
+            print(f"Spooled {len(batch)} records locally for retry")
+        except sqlite3.Error as e:
+            print(f"Spool error, {len(batch)} records lost: {e}")
+            try:
+                if self._spool.in_transaction:
+                    self._spool.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+    
+    def _drain_spool(self):
+        """Upload spooled records oldest first, deleting each batch once stored"""
+        if self._spool is None:
+            self._spool_has_rows = False
+            return
+        while True:
+            try:
+                rows = self._spool.execute(
+                    'SELECT id, timestamp, flow, velocity FROM flow_spool ORDER BY id LIMIT ?',
+                    (self.batch_size,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"Spool read error: {e}")
+                self._spool_has_rows = False
+                return
+            if not rows:
+                self._spool_has_rows = False
+                return
+            batch = [{'timestamp': ts, 'flow': flow, 'velocity': vel}
+                     for _, ts, flow, vel in rows]
+            ok = self.insert_batch(batch)
+            self._record_upload_result(ok)
+            if not ok:
+                return
+            try:
+                self._spool.execute('DELETE FROM flow_spool WHERE id <= ?', (rows[-1][0],))
+            except sqlite3.Error as e:
+                # Rows are already in Supabase; stop rather than resend them in a loop
+                print(f"Spool delete error, {len(rows)} uploaded records left in spool: {e}")
+                self._spool_has_rows = False
+                return
+    
+    def _record_upload_result(self, ok):
+        """Close the circuit breaker on success, back off further on failure"""
+        if ok:
+            self._fail_count = 0
+            self._open_until = 0.0
+            return
+        self._fail_count += 1
+        backoff = min(self.max_backoff, 2 ** self._fail_count)
+        self._open_until = time.monotonic() + backoff
+        action = "spooling new records" if self._spool is not None else "pausing uploads"
+        print(f"Upload failed {self._fail_count} time(s) in a row - {action} for {backoff:.0f} seconds")
+    
+    def insert_batch(self, batch):
+        """Insert a list of records into Supabase in one request, returning success"""
+        try:
+            response = self.supabase.table('flow_data').insert(batch).execute()
             if response.data:
-                local_dt = datetime.fromisoformat(self.current_record['timestamp'])
-                print(f"Stored: {local_dt.strftime('%Y-%m-%d %H:%M:%S')} | "
-                      f"Flow: {self.current_record['flow']:.3f} l/s | "
-                      f"Vel: {self.current_record['velocity']:.3f} m/s")
-            else:
-                print("Failed to store record - empty response")
+                for record in batch:
+                    local_dt = datetime.fromisoformat(record['timestamp'])
+                    print(f"Stored: {local_dt.strftime('%Y-%m-%d %H:%M:%S')} | "
+                          f"Flow: {record['flow']:.3f} l/s | "
+                          f"Vel: {record['velocity']:.3f} m/s")
+                return True
+            print(f"Failed to store {len(batch)} records - empty response")
         except Exception as e:
             print(f"Supabase error: {str(e)}")
+        return False
                     
     def run(self):
-        """Main loop to read from serial port and process data"""
+        """Main loop to read from serial port and process data.
+
+        Returns True after a Ctrl+C shutdown, False if the port never opened.
+        """
         if not self.connect_serial():
-            return
+            return False
             
         print("Flowmeter data collector started. Press Ctrl+C to stop.")
         print(f"Supabase endpoint: {self.supabase_url}")
+        self._uploader_thread.start()
         
         try:
+            # Bind hot-loop attributes to locals once
+            readline = self.ser.readline
+            append = self.ring_buffer.append
+            process = self.process_buffer
             while True:
-                if self.ser.in_waiting > 0:
-                    try:
-                        line = self.ser.readline().decode('ascii', errors='ignore')
-                        if line.strip():
-                            self.ring_buffer.append(line)
-                    except Exception as e:
-                        print(f"Serial read error: {e}")
-                        
-                self.process_buffer()
-                time.sleep(0.01)
+                # Blocks until a line arrives or the 1 s port timeout expires.
+                # SerialException (e.g. adapter unplugged) is fatal: let it end
+                # the process so the container restart policy reconnects.
+                line = readline().decode('ascii', errors='ignore')
+                if line.strip():
+                    append(line)
+                    
+                process()
                 
         except KeyboardInterrupt:
             print("\nShutting down gracefully...")
+            return True
+        except serial.SerialException as e:
+            print(f"Serial read error: {e}")
+            raise
         finally:
             self.process_buffer()
+            # Let the uploader send whatever is still queued, then stop it.
+            # Never block here: the uploader may be stuck or already dead.
+            self._stopping.set()
+            try:
+                self._upload_q.put_nowait(None)
+            except queue.Full:
+                try:
+                    self._upload_q.get_nowait()
+                except queue.Empty:
+                    pass
+                self._upload_q.put_nowait(None)
+            self._uploader_thread.join(timeout=self.shutdown_timeout)
+            if self._uploader_thread.is_alive():
+                print(f"Uploader did not finish within {self.shutdown_timeout:g} seconds, "
+                      f"{self._upload_q.qsize()} queued records not sent")
             if hasattr(self, 'ser') and self.ser and self.ser.is_open:
                 self.ser.close()
             print("Flowmeter collector stopped.")
 
-def main():
+def main(supabase=None):
     print("[DEBUG] read_and_store.py main() starting...")
     print(f"[DEBUG] SERIAL_PORT: {os.getenv('SERIAL_PORT', '/dev/ttyUSB0')}")
     # Configuration - can be overridden by environment variables
     PORT = os.getenv('SERIAL_PORT', '/dev/ttyUSB0')
     BAUD_RATE = int(os.getenv('BAUD_RATE', '9600'))
     BUFFER_SIZE = int(os.getenv('BUFFER_SIZE', '1000'))
+    BATCH_SIZE = int(os.getenv('BATCH_SIZE', '32'))
+    FLUSH_INTERVAL = float(os.getenv('FLUSH_INTERVAL', '5.0'))
+    SPOOL_PATH = os.getenv('SPOOL_PATH', 'data/spool.db')
     
     collector = FlowmeterDataCollector(
         port=PORT,
         baudrate=BAUD_RATE,
-        buffer_size=BUFFER_SIZE
+        buffer_size=BUFFER_SIZE,
+        batch_size=BATCH_SIZE,
+        flush_interval=FLUSH_INTERVAL,
+        spool_path=SPOOL_PATH,
+        supabase=supabase
     )
-    collector.run()
+    return collector.run()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
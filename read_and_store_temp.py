@@ -1,16 +1,25 @@
 import os
+import logging
 import serial
+import struct
 import time
 from datetime import datetime, timezone
-from supabase import create_client
-from dotenv import load_dotenv
+from read_and_store import connect_supabase
 
-# --- BCD/Frame Parsing Functions (unchanged, with all debug prints) ---
+log = logging.getLogger(__name__)
+
+# T1/T2 raw readings: two big-endian u16 values at frame offset 2
+_T1_T2 = struct.Struct('>HH')
+
+# Decoded value of every possible packed-BCD byte
+_BCD = bytes(((b >> 4) * 10) + (b & 0x0F) for b in range(256))
+
+# --- BCD/Frame Parsing Functions (debug output via log.debug) ---
 def bcd_to_int(bcd_byte):
-    return ((bcd_byte >> 4) * 10) + (bcd_byte & 0x0F)
+    return _BCD[bcd_byte]
 
 def bcd_bytes_to_int(b1, b2):
-    return ((b1 >> 4) * 1000 + (b1 & 0x0F) * 100 + (b2 >> 4) * 10 + (b2 & 0x0F))
+    return _BCD[b1] * 100 + _BCD[b2]
 
 def parse_frame(frame):
     if len(frame) != 8:
@@ -19,9 +28,11 @@ def parse_frame(frame):
     if frame[0] != 0x02:
         print(f"[Error] Invalid frame start: {frame[0]:02X}")
         return
-    t1 = (frame[2] << 8 | frame[3]) / 10.0
-    t2 = (frame[4] << 8 | frame[5]) / 10.0
-    print(f"[T1] {t1:.2f} °C, [T2] {t2:.2f} °C | Frame: {' '.join(f'{b:02X}' for b in frame)}")
+    t1_raw, t2_raw = _T1_T2.unpack_from(frame, 2)
+    t1 = t1_raw / 10.0
+    t2 = t2_raw / 10.0
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"[T1] {t1:.2f} °C, [T2] {t2:.2f} °C | Frame: {frame.hex(' ').upper()}")
 
 def parse_temperature(frame):
     if len(frame) < 8:
@@ -37,42 +48,66 @@ def parse_temperature(frame):
     digit2_raw = frame[4]
     digit3_raw = frame[5]
     digit4_raw = frame[6]
-    digit1 = bcd_to_int(digit1_raw)
-    digit2 = bcd_to_int(digit2_raw)
-    digit3 = bcd_to_int(digit3_raw)
-    digit4 = bcd_to_int(digit4_raw)
-    print(f"[Debug] Raw BCD bytes: {digit1_raw:02X} {digit2_raw:02X} {digit3_raw:02X} {digit4_raw:02X}")
-    print(f"[Debug] Parsed BCD digits: {digit1} {digit2} {digit3} {digit4}")
-    print(f"[Debug] sign: {sign}, decimal_point: {decimal_point}")
+    digit1 = _BCD[digit1_raw]
+    digit2 = _BCD[digit2_raw]
+    digit3 = _BCD[digit3_raw]
+    digit4 = _BCD[digit4_raw]
+    log.debug("[Debug] Raw BCD bytes: %02X %02X %02X %02X", digit1_raw, digit2_raw, digit3_raw, digit4_raw)
+    log.debug("[Debug] Parsed BCD digits: %d %d %d %d", digit1, digit2, digit3, digit4)
+    log.debug("[Debug] sign: %d, decimal_point: %d", sign, decimal_point)
     value = digit1 * 1000 + digit2 * 100 + digit3 * 10 + digit4
     temperature = sign * (value / (10 ** decimal_point))
-    print(f"[Debug] Parsed temperature: {temperature:.2f} °C from frame: {' '.join(f'{b:02X}' for b in frame)}")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"[Debug] Parsed temperature: {temperature:.2f} °C from frame: {frame.hex(' ').upper()}")
     return temperature
 
 def find_frame(buffer):
+    debug = log.isEnabledFor(logging.DEBUG)
     found_any = False
-    for i in range(len(buffer) - 7):
-        if buffer[i] == 0x02:
-            candidate = buffer[i:i+8]
-            print(f"[Debug] 8-byte sequence from 0x02: {' '.join(f'{b:02X}' for b in candidate)}")
-            found_any = True
-            if candidate[7] == 0x03:
-                print(f"[Debug] Found valid frame: {' '.join(f'{b:02X}' for b in candidate)}")
-                return candidate, i+8
+    # Only positions with a full 8 bytes after them can start a frame
+    end = max(len(buffer) - 7, 0)
+    i = buffer.find(0x02, 0, end)
+    while i >= 0:
+        candidate = buffer[i:i+8]
+        if debug:
+            log.debug(f"[Debug] 8-byte sequence from 0x02: {candidate.hex(' ').upper()}")
+        found_any = True
+        if candidate[7] == 0x03:
+            if debug:
+                log.debug(f"[Debug] Found valid frame: {candidate.hex(' ').upper()}")
+            return candidate, i+8
+        i = buffer.find(0x02, i + 1, end)
     if not found_any:
-        print("[Debug] No 8-byte sequence starting with 0x02 found in buffer.")
+        log.debug("[Debug] No 8-byte sequence starting with 0x02 found in buffer.")
     return None, 0
 
-# --- Supabase Setup ---
-load_dotenv()
-SUPABASE_URL = os.getenv('SUPABASE_URL')
-SUPABASE_KEY = os.getenv('SUPABASE_KEY')
-if not all([SUPABASE_URL, SUPABASE_KEY]):
-    raise ValueError("Missing Supabase credentials in environment variables")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+def parse_frames(buffer, length=None):
+    """Decode every 8-byte candidate starting with 0x02 in one pass.
+
+    Only the first `length` bytes are scanned (default: the whole buffer).
+    Returns a list of (start, t1_raw, t2_raw) tuples in buffer order.
+    """
+    if length is None:
+        length = len(buffer)
+    frames = []
+    end = max(length - 7, 0)
+    i = buffer.find(0x02, 0, end)
+    while i >= 0:
+        frames.append((i, *_T1_T2.unpack_from(buffer, i + 2)))
+        i = buffer.find(0x02, i + 1, end)
+    return frames
 
 # --- Main Loop ---
-def main():
+def main(supabase=None):
+    log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    level = logging.getLevelName(log_level)
+    if not isinstance(level, int):
+        print(f"[Warning] Unknown LOG_LEVEL {log_level!r}, using INFO")
+        level = logging.INFO
+    logging.basicConfig(level=level, format='%(message)s')
+    # --- Supabase Setup (pass a client in to share it with the flowmeter) ---
+    if supabase is None:
+        supabase = connect_supabase()
     print("[DEBUG] read_and_store_temp.py main() starting...")
     print(f"[DEBUG] SERIAL_PORT_TEMP: {os.getenv('SERIAL_PORT_TEMP', '/dev/ttyUSB1')}")
     port_name = os.getenv('SERIAL_PORT_TEMP', '/dev/ttyUSB1')  # Can override with env var
@@ -92,9 +127,12 @@ def main():
         print(f"[Opened] Serial port {port_name} at {baud_rate} baud")
         print("[Info] Waiting for device to stabilize...")
         time.sleep(2)
-        buffer = bytearray()
+        # Fixed 64-byte buffer (32 kept + one 32-byte read); `filled` marks the end of valid data
+        buffer = bytearray(64)
+        filled = 0
         consecutive_errors = 0
         last_valid_frame = None
+        next_read = time.monotonic()
         while True:
             ser.write(b'A')
             print("\n[Sent] Command 'A'")
@@ -102,36 +140,31 @@ def main():
             chunk = ser.read(32)
             if chunk:
                 print(f"[Received] {len(chunk)} bytes")
-                print(f"[Raw] {' '.join(f'{b:02X}' for b in chunk)}")
-                buffer += chunk
-                print(f"[Debug] Full buffer: {' '.join(f'{b:02X}' for b in buffer)}")
-                for i in range(len(buffer) - 7):
-                    candidate = buffer[i:i+8]
-                    if candidate[0] == 0x02:
-                        parse_frame(candidate)
+                n = len(chunk)
+                buffer[filled:filled + n] = chunk
+                filled += n
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f"[Raw] {chunk.hex(' ').upper()}")
+                    log.debug(f"[Debug] Full buffer: {buffer[:filled].hex(' ').upper()}")
+                # Single pass: decode every 8-byte candidate starting with 0x02
+                frames = parse_frames(buffer, filled)
+                if log.isEnabledFor(logging.DEBUG):
+                    for start, _, _ in frames:
+                        parse_frame(buffer[start:start+8])
                 # Only upload the correct T1/T2 (second line) to Supabase
-                t1_to_upload = None
-                t2_to_upload = None
-                found = 0
-                for i in range(len(buffer) - 7):
-                    candidate = buffer[i:i+8]
-                    if candidate[0] == 0x02:
-                        t1 = (candidate[2] << 8 | candidate[3]) / 10.0
-                        t2 = (candidate[4] << 8 | candidate[5]) / 10.0
-                        found += 1
-                        if found == 2:  # The second valid frame
-                            t1_to_upload = t1
-                            t2_to_upload = t2
-                            break
-                if t1_to_upload is not None and t2_to_upload is not None:
-                    if 10 <= t1_to_upload <= 100 and 10 <= t2_to_upload <= 100:
+                if len(frames) >= 2:  # The second valid frame
+                    _, t1_raw, t2_raw = frames[1]
+                    # 10-100 °C, checked on the raw tenths of a degree
+                    if 100 <= t1_raw <= 1000 and 100 <= t2_raw <= 1000:
+                        t1_to_upload = t1_raw / 10.0
+                        t2_to_upload = t2_raw / 10.0
                         now = datetime.now(timezone.utc).isoformat()
                         data_to_upload = {
                             'timestamp': now,
                             't1': t1_to_upload,
                             't2': t2_to_upload
                         }
-                        print(f"[DEBUG] Data to upload: {data_to_upload}")
+                        log.debug("[DEBUG] Data to upload: %s", data_to_upload)
                         # Upload to Supabase
                         try:
                             response = supabase.table('temperature_data').insert(data_to_upload).execute()
@@ -142,20 +175,27 @@ def main():
                         except Exception as e:
                             print(f"[Supabase error] {str(e)}")
                     else:
-                        print(f"[DEBUG] Skipped upload: T1={t1_to_upload}, T2={t2_to_upload} (out of range)")
+                        log.debug("[DEBUG] Skipped upload: T1=%s, T2=%s (out of range)", t1_raw / 10.0, t2_raw / 10.0)
                 # Keep only the last 32 bytes if buffer is growing too large
-                if len(buffer) > 32:
-                    buffer = buffer[-32:]
+                if filled > 32:
+                    buffer[:32] = buffer[filled - 32:filled]
+                    filled = 32
             else:
                 print("[No data received]")
                 consecutive_errors += 1
             if consecutive_errors >= 5:
                 print("[Error] Too many consecutive errors - consider checking device connection")
                 if last_valid_frame:
-                    print(f"[Info] Last valid frame was: {' '.join(f'{b:02X}' for b in last_valid_frame)}")
+                    print(f"[Info] Last valid frame was: {last_valid_frame.hex(' ').upper()}")
                 break
             # --- Wait for the next reading/upload ---
-            time.sleep(READ_INTERVAL)
+            # Sleep until a fixed deadline so time spent reading doesn't drift the period
+            next_read += READ_INTERVAL
+            delay = next_read - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_read = time.monotonic()
     except serial.SerialException as e:
         print(f"[Error] Serial port issue: {e}")
     finally: